@@ -1,2 +1,3 @@
 
-from .load_kl11 import load_kl11_camera, load_kl11_voxel_grid, load_kl11_sensitivity_matrix
+from .load_kl11 import load_kl11_camera, load_kl11_voxel_grid, load_kl11_sensitivity_matrix, \
+    build_kl11_sensitivity_cache
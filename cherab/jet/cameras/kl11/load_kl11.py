@@ -1,7 +1,8 @@
 
 import os
-import csv
+import textwrap
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from raysect.core import Point2D
 from raysect.optical.observer import PowerPipeline2D, VectorCamera
@@ -9,9 +10,37 @@ from cherab.tools.observers import load_calcam_calibration
 from cherab.tools.inversions import ToroidalVoxelGrid
 
 
+_DATA_PATH = os.path.split(__file__)[0]
+_DEFAULT_KL11_DATA_PATH = '/work/mcarr/tasks/kl11/data'
+_CAMERA_DIMENSION = 334
+_GRID_LENGTH = 8893
+
+
+def _kl11_data_file(file_name):
+
+    # the calibration and sensitivity matrices are not shipped with the package
+    return os.path.join(os.environ.get('KL11_DATA', _DEFAULT_KL11_DATA_PATH), file_name)
+
+
+def _missing_kl11_data(file_name):
+
+    message = textwrap.dedent(
+        """
+        {}
+        not found: please set the KL11_DATA environment variable
+        to the directory holding the KL11 calibration and sensitivity matrices."""
+        .format(file_name)
+    )
+    return FileNotFoundError(message)
+
+
 def load_kl11_camera(parent=None, pipelines=None, stride=1):
 
-    camera_config = load_calcam_calibration('/home/mcarr/cherab/cherab_jet/cherab/jet/cameras/kl11/KL11-E1DC_87516.nc')
+    calibration_file = _kl11_data_file('KL11-E1DC_87516.nc')
+    if not os.path.isfile(calibration_file):
+        raise _missing_kl11_data(calibration_file)
+
+    camera_config = load_calcam_calibration(calibration_file)
 
     if not pipelines:
         power_unfiltered = PowerPipeline2D(display_unsaturated_fraction=0.96, name="Unfiltered Power (W)")
@@ -19,61 +48,205 @@ def load_kl11_camera(parent=None, pipelines=None, stride=1):
         pipelines = [power_unfiltered]
 
     pixels_shape, pixel_origins, pixel_directions = camera_config
-    camera = VectorCamera(pixel_origins[::stride, ::stride], pixel_directions[::stride, ::stride],
-                          pipelines=pipelines, parent=parent)
+
+    # copy out only the strided pixels and drop the full resolution calibration before building the camera
+    pixel_origins = np.ascontiguousarray(pixel_origins[::stride, ::stride])
+    pixel_directions = np.ascontiguousarray(pixel_directions[::stride, ::stride])
+    del camera_config
+
+    camera = VectorCamera(pixel_origins, pixel_directions, pipelines=pipelines, parent=parent)
     camera.spectral_bins = 15
     camera.pixel_samples = 1
 
     return camera
 
 
-def load_kl11_voxel_grid(parent=None, name=None):
+def _read_voxel_coordinates():
+
+    voxel_grid_file = os.path.join(_DATA_PATH, "kl11_voxel_grid.csv")
+    voxel_cache_file = os.path.join(_DATA_PATH, "kl11_voxel_grid.npy")
+
+    # parsing the csv is the slow part of loading the grid, so keep a binary copy alongside it
+    try:
+        if os.path.getmtime(voxel_cache_file) >= os.path.getmtime(voxel_grid_file):
+            return np.load(voxel_cache_file)
+    except OSError:
+        pass
+
+    # rows are: voxel index, r1, z1, r2, z2, r3, z3, r4, z4 - the index column is skipped rather than parsed
+    coordinates = np.loadtxt(voxel_grid_file, delimiter=',', usecols=range(1, 9)).reshape((-1, 4, 2))
 
-    directory = os.path.split(__file__)[0]
-    voxel_grid_file = os.path.join(directory, "kl11_voxel_grid.csv")
+    # write under a temporary name so concurrent jobs never read a partially written cache
+    temporary_file = '{}.{}.partial'.format(voxel_cache_file, os.getpid())
+    try:
+        with open(temporary_file, 'wb') as fh:
+            np.save(fh, coordinates)
+        os.replace(temporary_file, voxel_cache_file)
+    except OSError:
+        pass
+    finally:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
 
-    voxel_coordinates = []
-    with open(voxel_grid_file, 'r') as fh:
-        reader = csv.reader(fh)
+    return coordinates
 
-        for row in reader:
-            v1 = Point2D(float(row[1]), float(row[2]))
-            v2 = Point2D(float(row[3]), float(row[4]))
-            v3 = Point2D(float(row[5]), float(row[6]))
-            v4 = Point2D(float(row[7]), float(row[8]))
-            voxel_coordinates.append((v1, v2, v3, v4))
+
+def load_kl11_voxel_grid(parent=None, name=None):
+
+    coordinates = _read_voxel_coordinates()
+
+    voxel_coordinates = [tuple(Point2D(r, z) for r, z in voxel) for voxel in coordinates.tolist()]
 
     voxel_grid = ToroidalVoxelGrid(voxel_coordinates, parent=parent, name=name, primitive_type='csg')
 
     return voxel_grid
 
 
-def load_kl11_sensitivity_matrix(camera='c', reflections=True):
+def _sensitivity_file(camera, reflections, transposed=False):
 
-    base_path = '/work/mcarr/tasks/kl11/data'
-    camera_dimension = 334
-    grid_length = 8893
+    if camera not in ('c', 'd', 'e'):
+        raise ValueError("Unidentified KL11 camera - '{}'".format(camera))
 
-    if camera == 'c':
-        if reflections:
-            sensitivity = np.load(os.path.join(base_path, 'kl11_c_rf_sensitivity_matrix.npy')).reshape((grid_length, camera_dimension * camera_dimension))
-        else:
-            sensitivity = np.load(os.path.join(base_path, 'kl11_c_norf_sensitivity_matrix.npy')).reshape((grid_length, camera_dimension * camera_dimension))
+    file_name = 'kl11_{}_{}_sensitivity_matrix{}.npy'.format(camera, 'rf' if reflections else 'norf',
+                                                              '_transposed' if transposed else '')
 
-    elif camera == 'd':
-        if reflections:
-            sensitivity = np.load(os.path.join(base_path, 'kl11_d_rf_sensitivity_matrix.npy')).reshape((grid_length, camera_dimension * camera_dimension))
-        else:
-            sensitivity = np.load(os.path.join(base_path, 'kl11_d_norf_sensitivity_matrix.npy')).reshape((grid_length, camera_dimension * camera_dimension))
+    return _kl11_data_file(file_name)
+
+
+def _load_sensitivity_file(file_name, shape, layouts=()):
+
+    try:
+        sensitivity = np.load(file_name, mmap_mode='r')
+    except FileNotFoundError:
+        raise _missing_kl11_data(file_name) from None
+
+    # only the header has been read at this point, so a bad file is rejected before any data is touched,
+    # the shape is compared rather than the size so a matrix stored in the wrong orientation is caught
+    if sensitivity.shape != shape and sensitivity.shape not in layouts:
+        raise ValueError("KL11 sensitivity matrix '{}' has shape {}, expected {}."
+                         "".format(file_name, sensitivity.shape, shape))
+
+    return sensitivity.reshape(shape)
+
+
+def _copy_transposed(source, destination, tile_size=256):
+
+    # a naive transpose strides through memory on every write; copying in square
+    # tiles keeps both the source and destination rows of a tile in cache
+    rows, columns = source.shape
+    for i in range(0, rows, tile_size):
+        for j in range(0, columns, tile_size):
+            destination[j:j + tile_size, i:i + tile_size] = source[i:i + tile_size, j:j + tile_size].T
 
-    elif camera == 'e':
-        if reflections:
-            sensitivity = np.load(os.path.join(base_path, 'kl11_e_rf_sensitivity_matrix.npy')).reshape((grid_length, camera_dimension * camera_dimension))
+
+def _gather_rows(source, indices, dtype, block_size=1024, max_workers=None):
+
+    gathered = np.empty((len(indices), source.shape[1]), dtype=dtype)
+
+    def gather_block(start):
+        block_indices = indices[start:start + block_size]
+        if gathered.dtype == source.dtype:
+            # the indices are known to be in range, so clip mode lets take write straight into the output
+            np.take(source, block_indices, axis=0, out=gathered[start:start + block_size], mode='clip')
         else:
-            sensitivity = np.load(os.path.join(base_path, 'kl11_e_norf_sensitivity_matrix.npy')).reshape((grid_length, camera_dimension * camera_dimension))
+            # a dtype change needs a temporary in the source dtype before the cast
+            gathered[start:start + block_size] = np.take(source, block_indices, axis=0)
 
-    else:
-        raise ValueError("Unidentified KL11 camera - '{}'".format(camera))
+    # numpy releases the GIL while gathering, so blocks are gathered concurrently
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(gather_block, range(0, len(indices), block_size)))
+
+    return gathered
+
+
+def build_kl11_sensitivity_cache(camera='c', reflections=True, dtype=None, block_size=1024, max_workers=None):
+    """
+    Write a copy of a KL11 sensitivity matrix stored in (pixel, voxel) order.
+
+    This is the orientation returned by load_kl11_sensitivity_matrix(), so once
+    the cache exists the matrix can be memory mapped without a transpose.
+
+    :param camera: KL11 camera id, one of 'c', 'd' or 'e'.
+    :param reflections: Use the sensitivities calculated with reflections.
+    :param dtype: Data type of the cached matrix (default: the source dtype). A reduced
+      precision cache, e.g. float32, is only used by loads that request that precision.
+    :param block_size: Number of pixels transposed by each task.
+    :param max_workers: Number of threads used to copy blocks (default: ThreadPoolExecutor default).
+    """
+
+    cache_file = _sensitivity_file(camera, reflections, transposed=True)
+    temporary_file = '{}.{}.partial'.format(cache_file, os.getpid())
+
+    num_pixels = _CAMERA_DIMENSION * _CAMERA_DIMENSION
+    source = _load_sensitivity_file(_sensitivity_file(camera, reflections), (_GRID_LENGTH, num_pixels),
+                                    [(_GRID_LENGTH, _CAMERA_DIMENSION, _CAMERA_DIMENSION)])
+
+    # write under a temporary name so an interrupted or concurrent build is never picked up by the loader
+    cache = np.lib.format.open_memmap(temporary_file, mode='w+', dtype=dtype or source.dtype,
+                                      shape=(num_pixels, _GRID_LENGTH))
+
+    def copy_block(start):
+        _copy_transposed(source[:, start:start + block_size], cache[start:start + block_size])
+
+    try:
+        # numpy releases the GIL while copying, so blocks are read and written concurrently
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(copy_block, range(0, num_pixels, block_size)))
+        cache.flush()
+
+        # release the memory maps so both files are closed before the cache is moved into place
+        del cache, source
+
+        os.replace(temporary_file, cache_file)
+
+    finally:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+
+
+def _cache_is_current(cache_file, source_file):
+
+    try:
+        cache_time = os.path.getmtime(cache_file)
+    except OSError:
+        return False
+
+    # a cache without its source is still usable, one older than its source is stale
+    try:
+        return cache_time >= os.path.getmtime(source_file)
+    except OSError:
+        return True
+
+
+def load_kl11_sensitivity_matrix(camera='c', reflections=True, stride=1, dtype=np.float64, max_workers=None):
+
+    if isinstance(stride, bool) or not isinstance(stride, (int, np.integer)) or stride < 1:
+        raise ValueError("The KL11 sensitivity stride must be an integer >= 1, got '{}'.".format(stride))
+
+    cache_file = _sensitivity_file(camera, reflections, transposed=True)
+    num_pixels = _CAMERA_DIMENSION * _CAMERA_DIMENSION
+
+    cache = None
+    if _cache_is_current(cache_file, _sensitivity_file(camera, reflections)):
+        cache = _load_sensitivity_file(cache_file, (num_pixels, _GRID_LENGTH))
+        # a reduced precision cache only serves callers that asked for that precision
+        if cache.dtype.itemsize < np.dtype(dtype).itemsize:
+            cache = None
+
+    # the files are memory mapped and the selected pixels are copied once into a writable, contiguous array
+    if cache is not None:
+        # each pixel is a contiguous row of the pixel-major cache, so only the selected rows are read from disk
+        if stride == 1:
+            return np.array(cache, dtype=dtype)
+
+        pixels = np.arange(0, _CAMERA_DIMENSION, stride)
+        pixel_indices = (pixels[:, None] * _CAMERA_DIMENSION + pixels).ravel()
+        return _gather_rows(cache, pixel_indices, dtype, max_workers=max_workers)
+
+    source = _load_sensitivity_file(_sensitivity_file(camera, reflections),
+                                    (_GRID_LENGTH, _CAMERA_DIMENSION, _CAMERA_DIMENSION), [(_GRID_LENGTH, num_pixels)])
 
-    return np.swapaxes(sensitivity, 0, 1)
+    # copy the selected pixels out of the voxel-major source straight into pixel-major order
+    sensitivity = np.array(source[:, ::stride, ::stride].transpose((1, 2, 0)), dtype=dtype, order='C')
 
+    return sensitivity.reshape((-1, _GRID_LENGTH))
@@ -0,0 +1,178 @@
+
+import os
+import csv
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from cherab.jet.cameras.kl11 import load_kl11, load_kl11_sensitivity_matrix, build_kl11_sensitivity_cache
+
+
+CAMERA_DIMENSION = 6
+GRID_LENGTH = 7
+
+
+class TestKL11SensitivityMatrix(unittest.TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+        patches = [
+            mock.patch.dict(os.environ, {'KL11_DATA': self.directory.name}),
+            mock.patch.object(load_kl11, '_CAMERA_DIMENSION', CAMERA_DIMENSION),
+            mock.patch.object(load_kl11, '_GRID_LENGTH', GRID_LENGTH),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        # voxel-major source matrix, as produced by the sensitivity calculation
+        self.source = np.random.default_rng(0).random((GRID_LENGTH, CAMERA_DIMENSION * CAMERA_DIMENSION))
+        np.save(os.path.join(self.directory.name, 'kl11_c_rf_sensitivity_matrix.npy'), self.source)
+
+    def expected(self, stride):
+        pixels = self.source.T.reshape((CAMERA_DIMENSION, CAMERA_DIMENSION, GRID_LENGTH))
+        return pixels[::stride, ::stride].reshape((-1, GRID_LENGTH))
+
+    def test_cached_and_uncached_agree(self):
+
+        uncached = {stride: load_kl11_sensitivity_matrix(stride=stride) for stride in (1, 2, 3)}
+
+        build_kl11_sensitivity_cache(dtype=np.float64, block_size=5, max_workers=2)
+        cached = {stride: load_kl11_sensitivity_matrix(stride=stride, max_workers=2) for stride in (1, 2, 3)}
+
+        for stride in (1, 2, 3):
+            with self.subTest(stride=stride):
+                np.testing.assert_array_equal(uncached[stride], self.expected(stride))
+                np.testing.assert_array_equal(cached[stride], self.expected(stride))
+                self.assertEqual(cached[stride].dtype, np.float64)
+                self.assertTrue(cached[stride].flags.c_contiguous)
+                self.assertTrue(cached[stride].flags.writeable)
+                for sensitivity in (uncached[stride], cached[stride]):
+                    self.assertIs(type(sensitivity), np.ndarray)
+                    self.assertTrue(sensitivity.flags.c_contiguous)
+
+    def test_float32_cache(self):
+
+        build_kl11_sensitivity_cache(dtype=np.float32, block_size=5)
+
+        for stride in (1, 2, 3):
+            with self.subTest(stride=stride):
+                # a float64 request must not be served from the reduced precision cache
+                sensitivity = load_kl11_sensitivity_matrix(stride=stride)
+                self.assertEqual(sensitivity.dtype, np.float64)
+                np.testing.assert_array_equal(sensitivity, self.expected(stride))
+
+                sensitivity = load_kl11_sensitivity_matrix(stride=stride, dtype=np.float32)
+                self.assertEqual(sensitivity.dtype, np.float32)
+                np.testing.assert_array_equal(sensitivity, self.expected(stride).astype(np.float32))
+
+    def test_default_cache_keeps_source_precision(self):
+
+        build_kl11_sensitivity_cache(block_size=5)
+
+        cache_file = os.path.join(self.directory.name, 'kl11_c_rf_sensitivity_matrix_transposed.npy')
+        self.assertEqual(np.load(cache_file, mmap_mode='r').dtype, self.source.dtype)
+
+    def test_source_in_camera_layout(self):
+
+        source = self.source.reshape((GRID_LENGTH, CAMERA_DIMENSION, CAMERA_DIMENSION))
+        np.save(os.path.join(self.directory.name, 'kl11_c_rf_sensitivity_matrix.npy'), source)
+
+        np.testing.assert_array_equal(load_kl11_sensitivity_matrix(stride=2), self.expected(2))
+
+    def test_stale_cache_is_ignored(self):
+
+        build_kl11_sensitivity_cache(dtype=np.float64)
+
+        source_file = os.path.join(self.directory.name, 'kl11_c_rf_sensitivity_matrix.npy')
+        cache_time = os.path.getmtime(source_file.replace('.npy', '_transposed.npy'))
+        self.source = 2 * self.source
+        np.save(source_file, self.source)
+        os.utime(source_file, (cache_time + 10, cache_time + 10))
+
+        np.testing.assert_array_equal(load_kl11_sensitivity_matrix(), self.expected(1))
+
+    def test_invalid_files(self):
+
+        with self.assertRaises(FileNotFoundError):
+            load_kl11_sensitivity_matrix(camera='d')
+
+        np.save(os.path.join(self.directory.name, 'kl11_e_rf_sensitivity_matrix.npy'), np.zeros((3, 3)))
+        with self.assertRaises(ValueError):
+            load_kl11_sensitivity_matrix(camera='e')
+
+        # same number of elements, but stored in the wrong orientation
+        np.save(os.path.join(self.directory.name, 'kl11_e_rf_sensitivity_matrix.npy'), self.source.T)
+        with self.assertRaises(ValueError):
+            load_kl11_sensitivity_matrix(camera='e')
+
+        np.save(os.path.join(self.directory.name, 'kl11_c_rf_sensitivity_matrix_transposed.npy'), self.source)
+        with self.assertRaises(ValueError):
+            load_kl11_sensitivity_matrix()
+
+        for stride in (0, True, 1.5):
+            with self.assertRaises(ValueError):
+                load_kl11_sensitivity_matrix(stride=stride)
+
+
+class TestKL11VoxelGrid(unittest.TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+        patch = mock.patch.object(load_kl11, '_DATA_PATH', self.directory.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.grid_file = os.path.join(self.directory.name, 'kl11_voxel_grid.csv')
+        self.cache_file = os.path.join(self.directory.name, 'kl11_voxel_grid.npy')
+        self.write_grid(np.random.default_rng(0).random((5, 8)))
+
+    def write_grid(self, coordinates):
+        with open(self.grid_file, 'w') as fh:
+            for index, row in enumerate(coordinates.tolist()):
+                fh.write(','.join([str(index)] + [repr(value) for value in row]) + '\n')
+
+    def read_grid(self):
+        # the original row by row parse of the csv
+        with open(self.grid_file, 'r') as fh:
+            return [[(float(row[i]), float(row[i + 1])) for i in (1, 3, 5, 7)] for row in csv.reader(fh)]
+
+    def test_coordinates_match_csv(self):
+
+        coordinates = load_kl11._read_voxel_coordinates()
+
+        self.assertEqual(coordinates.shape, (5, 4, 2))
+        self.assertEqual([[tuple(vertex) for vertex in voxel] for voxel in coordinates.tolist()], self.read_grid())
+
+    def test_cache_is_rebuilt_when_csv_is_newer(self):
+
+        load_kl11._read_voxel_coordinates()
+        self.assertTrue(os.path.isfile(self.cache_file))
+
+        self.write_grid(np.random.default_rng(1).random((3, 8)))
+        cache_time = os.path.getmtime(self.cache_file)
+        os.utime(self.grid_file, (cache_time + 10, cache_time + 10))
+
+        coordinates = load_kl11._read_voxel_coordinates()
+        self.assertEqual([[tuple(vertex) for vertex in voxel] for voxel in coordinates.tolist()], self.read_grid())
+        np.testing.assert_array_equal(np.load(self.cache_file), coordinates)
+
+    def test_unwritable_cache_falls_back_to_csv(self):
+
+        with mock.patch.object(load_kl11.np, 'save', side_effect=PermissionError):
+            coordinates = load_kl11._read_voxel_coordinates()
+
+        self.assertEqual([[tuple(vertex) for vertex in voxel] for voxel in coordinates.tolist()], self.read_grid())
+        self.assertEqual(os.listdir(self.directory.name), ['kl11_voxel_grid.csv'])
+
+
+if __name__ == '__main__':
+    unittest.main()
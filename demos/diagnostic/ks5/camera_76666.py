@@ -18,6 +18,10 @@
 # External imports
 import matplotlib.pyplot as plt
 plt.ion()
+import os
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from scipy.constants import electron_mass, atomic_mass
 from jet.data import sal
@@ -27,8 +31,8 @@ from raysect.optical.observer import PinholeCamera
 from raysect.optical.material import AbsorbingSurface
 
 # Internal imports
-from cherab.core.math import Interpolate1DCubic, IsoMapper2D, IsoMapper3D, AxisymmetricMapper, Blend2D, Constant2D, \
-    VectorAxisymmetricMapper
+from cherab.core.math import Interpolate1DCubic, IsoMapper2D, IsoMapper3D, AxisymmetricMapper, Blend2D, Constant1D, \
+    Constant2D, VectorAxisymmetricMapper
 from cherab.core import Plasma, Maxwellian, Species
 from cherab.core.atomic import Line, deuterium, carbon
 from cherab.core.model import SingleRayAttenuator, BeamCXLine
@@ -66,34 +70,74 @@ plasma = Plasma(parent=world)
 plasma.atomic_data = adas
 plasma.b_field = VectorAxisymmetricMapper(equil_time_slice.b_field)
 
+DDA_PATH = '/pulse/{}/ppf/signal/{}/{}:{}'
 DATA_PATH = '/pulse/{}/ppf/signal/{}/{}/{}:{}'
 user = 'cgiroud'
 sequence = 0
 
-psi_coord = sal.get(DATA_PATH.format(PULSE_PLASMA, user, 'PRFL', 'C6', sequence)).dimensions[0].data
-mask = psi_coord <= 1.0
-psi_coord = psi_coord[mask]
+# resolve the head sequence so the cached profiles below always refer to a fixed revision
+if sequence == 0:
+    sequence = sal.list(DDA_PATH.format(PULSE_PLASMA, user, 'PRFL', sequence)).revision_latest
 
-flow_velocity_tor_data = sal.get(DATA_PATH.format(PULSE_PLASMA, user, 'PRFL', 'VT', sequence)).data[mask]
-flow_velocity_tor_psi = Interpolate1DCubic(psi_coord, flow_velocity_tor_data)
-flow_velocity_tor = AxisymmetricMapper(Blend2D(Constant2D(0.0), IsoMapper2D(psin_2d, flow_velocity_tor_psi), inside_lcfs))
-flow_velocity = lambda x, y, z: Vector3D(y * flow_velocity_tor(x, y, z), - x * flow_velocity_tor(x, y, z), 0.) \
-                                / np.sqrt(x*x + y*y)
+profile_cache = os.path.join(tempfile.gettempdir(), 'ks5_prfl_{}_{}_{}.npz'.format(PULSE_PLASMA, user, sequence))
 
-ion_temperature_data = sal.get(DATA_PATH.format(PULSE_PLASMA, user, 'PRFL', 'TI', sequence)).data[mask]
+profiles = None
+if os.path.isfile(profile_cache):
+    try:
+        with np.load(profile_cache) as cached_profiles:
+            profiles = {name: cached_profiles[name] for name in ('PSI', 'VT', 'TI', 'NE', 'C6')}
+        print('Using cached profiles from {}'.format(profile_cache))
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        print('Ignoring unreadable profile cache {}'.format(profile_cache))
+
+if profiles is None:
+    # each profile is fetched once, and as they are independent requests the fetches run concurrently
+    profile_names = ('VT', 'TI', 'NE', 'C6')
+    profile_paths = [DATA_PATH.format(PULSE_PLASMA, user, 'PRFL', name, sequence) for name in profile_names]
+    with ThreadPoolExecutor(len(profile_paths)) as executor:
+        signals = dict(zip(profile_names, executor.map(sal.get, profile_paths)))
+
+    psi_coord = signals['C6'].dimensions[0].data
+    mask = psi_coord <= 1.0
+
+    # all profiles share the C6 psi coordinate, so order them by psi once here for every interpolator
+    order = np.argsort(psi_coord[mask])
+    profiles = {name: signal.data[mask][order] for name, signal in signals.items()}
+    profiles['PSI'] = psi_coord[mask][order]
+
+    # write under a temporary name so an interrupted run never leaves a truncated cache behind
+    temporary_file = '{}.{}.partial'.format(profile_cache, os.getpid())
+    with open(temporary_file, 'wb') as fh:
+        np.savez(fh, **profiles)
+    os.replace(temporary_file, profile_cache)
+
+psi_coord = profiles['PSI']
+
+
+def map_profile(profile_data):
+    profile_psi = Interpolate1DCubic(psi_coord, profile_data)
+    return AxisymmetricMapper(Blend2D(Constant2D(0.0), IsoMapper2D(psin_2d, profile_psi), inside_lcfs))
+
+
+flow_velocity_tor_data = profiles['VT']
+# mapped with the equilibrium so the flow is evaluated natively rather than through a python callback,
+# PRFL VT is positive in the -phi direction hence the sign flip
+flow_velocity = equil_time_slice.map_vector3d([psi_coord, -flow_velocity_tor_data], Constant1D(0.0), Constant1D(0.0))
+
+ion_temperature_data = profiles['TI']
 print("Ti between {} and {} eV".format(ion_temperature_data.min(), ion_temperature_data.max()))
-ion_temperature_psi = Interpolate1DCubic(psi_coord, ion_temperature_data)
-ion_temperature = AxisymmetricMapper(Blend2D(Constant2D(0.0), IsoMapper2D(psin_2d, ion_temperature_psi), inside_lcfs))
+ion_temperature = map_profile(ion_temperature_data)
 
-electron_density_data = sal.get(DATA_PATH.format(PULSE_PLASMA, user, 'PRFL', 'NE', sequence)).data[mask]
+electron_density_data = profiles['NE']
 print("Ne between {} and {} m-3".format(electron_density_data.min(), electron_density_data.max()))
-electron_density_psi = Interpolate1DCubic(psi_coord, electron_density_data)
-electron_density = AxisymmetricMapper(Blend2D(Constant2D(0.0), IsoMapper2D(psin_2d, electron_density_psi), inside_lcfs))
+electron_density = map_profile(electron_density_data)
+
+density_c6_data = profiles['C6']
+density_c6 = map_profile(density_c6_data)
 
-density_c6_data = sal.get(DATA_PATH.format(PULSE_PLASMA, user, 'PRFL', 'C6', sequence)).data[mask]
-density_c6_psi = Interpolate1DCubic(psi_coord, density_c6_data)
-density_c6 = AxisymmetricMapper(Blend2D(Constant2D(0.0), IsoMapper2D(psin_2d, density_c6_psi), inside_lcfs))
-density_d = lambda x, y, z: electron_density(x, y, z) - 6 * density_c6(x, y, z)
+# the interpolation and mapping are linear in the profile data, so the deuterium density is built from
+# ne - 6 * n_c6 in psi space, giving a native function rather than a python lambda
+density_d = map_profile(electron_density_data - 6 * density_c6_data)
 
 d_distribution = Maxwellian(density_d, ion_temperature, flow_velocity, deuterium.atomic_weight * atomic_mass)
 c6_distribution = Maxwellian(density_c6, ion_temperature, flow_velocity, carbon.atomic_weight * atomic_mass)
@@ -128,9 +172,16 @@ direction = Vector3D(-0.760612, -0.648906, -0.0197396).normalise()
 los = los + direction * 0.9
 up = Vector3D(0, 0, 1)
 
-camera = PinholeCamera((512, 512), fov=45, parent=world, transform=translate(los.x, los.y, los.z) * rotate_basis(direction, up))
-camera.pixel_samples = 50
-camera.spectral_bins = 15
+# render quality can be lowered for quick checks, either individually or with CHERAB_SMOKE=1
+smoke_test = os.environ.get('CHERAB_SMOKE') == '1'
+resolution = int(os.environ.get('KS5_RES', 64 if smoke_test else 512))
+pixel_samples = int(os.environ.get('KS5_SAMPLES', 1 if smoke_test else 50))
+spectral_bins = int(os.environ.get('KS5_BINS', 1 if smoke_test else 15))
+
+camera = PinholeCamera((resolution, resolution), fov=45, parent=world,
+                       transform=translate(los.x, los.y, los.z) * rotate_basis(direction, up))
+camera.pixel_samples = pixel_samples
+camera.spectral_bins = spectral_bins
 
 camera.observe()
 